@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import os
 import shutil
+import stat
 import sys
 import argparse
 import fnmatch
+import re
 import subprocess
 
 # Configuration
@@ -12,9 +14,22 @@ PACK_IGNORE = '.packignore'
 SERVER_PACK_DIR = 'server_pack'
 DEFAULT_BUILD_DIR = 'build'
 
+# Hardcoded specific ignores for tool operational files
+# We don't want to copy the usage files themselves into the build
+_HARDCODED_IGNORE = frozenset({
+    '.git', '.github', '.idea', 'build', '__pycache__',
+    CLIENT_FILES_IGNORE, PACK_IGNORE, SERVER_PACK_DIR, os.path.basename(__file__)
+})
+
+# fnmatch.fnmatch() compares case-insensitively where the OS does
+_PATTERN_FLAGS = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+_fold_case = str.lower if _PATTERN_FLAGS else str
+_GLOB_CHARS = '*?['
+_SEP_IS_SLASH = os.sep == '/'
+
 def load_ignore_patterns(root_dir, file_names):
     """
-    Loads ignore patterns from specific files.
+    Loads ignore patterns from specific files and compiles them.
     """
     patterns = []
     for file_name in file_names:
@@ -25,17 +40,18 @@ def load_ignore_patterns(root_dir, file_names):
                     line = line.strip()
                     if line and not line.startswith('#'):
                         patterns.append(line)
-    return patterns
+    return compile_ignore_patterns(patterns)
 
-def is_ignored(rel_path, patterns):
+def compile_ignore_patterns(patterns):
     """
-    Checks if a relative path matches any of the ignore patterns.
-    Implements a simplified version of gitignore logic.
+    Compiles gitignore-style patterns into a tuple of runs of consecutive
+    patterns sharing the same polarity:
+    (negate, literal_basenames, literal_paths, basename_re, path_re).
+    Patterns without glob characters go into frozensets for O(1) lookups,
+    the rest of a run is joined into one alternation regex per kind,
+    so a path is tested against a whole run in a single match call.
     """
-    # Normalize path separator to /
-    path = rel_path.replace(os.sep, '/')
-    ignored = False
-    
+    runs = []
     for pattern in patterns:
         negate = False
         current_pattern = pattern
@@ -44,62 +60,133 @@ def is_ignored(rel_path, patterns):
             negate = True
             current_pattern = current_pattern[1:]
             
-        should_ignore = False
-        
         # Directory-specific match (trailing slash)
         match_dir_only = current_pattern.endswith('/')
         if match_dir_only:
             current_pattern = current_pattern[:-1]
             
+        if not runs or runs[-1][0] != negate:
+            runs.append((negate, set(), set(), [], []))
+        _, literal_basenames, literal_paths, basename_res, path_res = runs[-1]
+        is_literal = not any(c in current_pattern for c in _GLOB_CHARS)
+            
         if '/' in current_pattern:
-            # Path match
+            # Path match: the pattern itself or anything below it
             if current_pattern.startswith('/'):
                 current_pattern = current_pattern[1:]
-                
-            if fnmatch.fnmatch(path, current_pattern):
-                should_ignore = True
-            elif path.startswith(current_pattern + '/'):
-                should_ignore = True
+            if is_literal:
+                literal_paths.add(_fold_case(current_pattern))
+            else:
+                path_res.append(fnmatch.translate(current_pattern))
+                path_res.append(re.escape(current_pattern + '/'))
         else:
             # Filename match (anywhere)
-            if fnmatch.fnmatch(os.path.basename(path), current_pattern):
-                should_ignore = True
-            # Also check if any component of the path matches
-            # e.g. pattern "bin" should match "foo/bin/bar"
-            # simple fnmatch on basename handles "bin", but strictly gitignore handles "bin/" differently?
-            # We'll stick to simple logic: match basename or match full path against pattern
-        
-        if should_ignore:
-            ignored = not negate
+            if is_literal:
+                literal_basenames.add(_fold_case(current_pattern))
+            else:
+                basename_res.append(fnmatch.translate(current_pattern))
             
-    return ignored
+    return tuple(
+        (negate, frozenset(literal_basenames), frozenset(literal_paths),
+         _compile_alternation(basename_res), _compile_alternation(path_res))
+        for negate, literal_basenames, literal_paths, basename_res, path_res in runs
+    )
+
+def _compile_alternation(regexes):
+    if not regexes:
+        return None
+    return re.compile('|'.join(f'(?:{r})' for r in regexes), _PATTERN_FLAGS)
+
+def _has_literal_prefix(path, literal_paths):
+    """Checks if the path or one of its parent directories is in literal_paths."""
+    if path in literal_paths:
+        return True
+    i = path.find('/')
+    while i != -1:
+        if path[:i] in literal_paths:
+            return True
+        i = path.find('/', i + 1)
+    return False
 
-def copy_tree(src, dst, ignore_patterns=[], keep_structure_only_dirs=[]):
+def is_ignored(rel_path, patterns):
+    """
+    Checks if a relative path matches any of the compiled ignore patterns.
+    Implements a simplified version of gitignore logic.
+    """
+    # Normalize path separator to /
+    path = rel_path if _SEP_IS_SLASH else rel_path.replace(os.sep, '/')
+    basename = os.path.basename(path)
+    folded_path = _fold_case(path)
+    folded_basename = _fold_case(basename)
+    
+    # Later patterns override earlier ones, so the last matching run decides
+    for negate, literal_basenames, literal_paths, basename_re, path_re in reversed(patterns):
+        if (folded_basename in literal_basenames
+                or (literal_paths and _has_literal_prefix(folded_path, literal_paths))
+                or (basename_re and basename_re.match(basename))
+                or (path_re and path_re.match(path))):
+            return not negate
+            
+    return False
+
+def _fast_copy(src, dst, st):
+    """
+    Copies a file in-kernel via copy_file_range() where available,
+    then restores its mode and timestamps. Unlike shutil.copy2() this
+    skips xattrs and flags, which are irrelevant for the build tree.
+    """
+    remaining = st.st_size
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+        except OSError:
+            # Not supported by every filesystem/kernel
+            remaining = st.st_size
+    if remaining > 0 or not hasattr(os, 'copy_file_range'):
+        # Uses sendfile() on Linux
+        shutil.copyfile(src, dst)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def copy_tree(src, dst, ignore_patterns=(), keep_structure_only_dirs=[]):
     """
     Copies files from src to dst, respecting ignore patterns.
     """
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-        
-    for item in os.listdir(src):
-        src_path = os.path.join(src, item)
-        dst_path = os.path.join(dst, item)
-        
-        rel_path = os.path.relpath(src_path, start=os.getcwd())
+    # Relative paths (with '/' separators) are built by concatenation as we
+    # descend instead of calling os.path.relpath() for every entry.
+    rel_src = os.path.relpath(src, start=os.getcwd())
+    rel_prefix = '' if rel_src == os.curdir else rel_src.replace(os.sep, '/') + '/'
+    
+    pending = [(src, dst, rel_prefix)]
+    while pending:
+        src_dir, dst_dir, rel_prefix = pending.pop()
+        os.makedirs(dst_dir, exist_ok=True)
         
-        # Hardcoded specific ignores for tool operational files
-        # We don't want to copy the usage files themselves into the build
-        if item in ['.git', '.github', '.idea', 'build', '__pycache__', CLIENT_FILES_IGNORE, PACK_IGNORE, SERVER_PACK_DIR, os.path.basename(__file__)]:
-            continue
-            
-        if is_ignored(rel_path, ignore_patterns):
-            # print(f"Ignored: {rel_path}")
-            continue
-            
-        if os.path.isdir(src_path):
-            copy_tree(src_path, dst_path, ignore_patterns)
-        else:
-            shutil.copy2(src_path, dst_path)
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                item = entry.name
+                src_path = entry.path
+                dst_path = dst_dir + os.sep + item
+                
+                rel_path = rel_prefix + item
+                
+                if item in _HARDCODED_IGNORE:
+                    continue
+                    
+                # An ignored directory prunes its whole subtree
+                if is_ignored(rel_path, ignore_patterns):
+                    continue
+                    
+                # DirEntry.is_dir() reuses the file type from the directory listing
+                if entry.is_dir():
+                    pending.append((src_path, dst_path, rel_path + '/'))
+                else:
+                    _fast_copy(src_path, dst_path, entry.stat())
 
 def merge_tree(src, dst):
     """
@@ -109,17 +196,19 @@ def merge_tree(src, dst):
         print(f"Warning: Source directory for merge '{src}' does not exist. Skipping.")
         return
 
-    if not os.path.exists(dst):
-        os.makedirs(dst)
+    pending = [(src, dst)]
+    while pending:
+        src_dir, dst_dir = pending.pop()
+        os.makedirs(dst_dir, exist_ok=True)
 
-    for item in os.listdir(src):
-        src_path = os.path.join(src, item)
-        dst_path = os.path.join(dst, item)
-        
-        if os.path.isdir(src_path):
-            merge_tree(src_path, dst_path)
-        else:
-            shutil.copy2(src_path, dst_path)
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                dst_path = dst_dir + os.sep + entry.name
+                
+                if entry.is_dir():
+                    pending.append((entry.path, dst_path))
+                else:
+                    _fast_copy(entry.path, dst_path, entry.stat())
 
 def run_cmd(cmd_list, cwd=None):
     """Runs a subprocess command and exits on failure."""
@@ -159,11 +248,13 @@ def build_mode(mode, root_dir, output_dir=None):
 
     # 2. Determine Ignore Patterns
     # Base ignores: .packignore
-    ignore_patterns = load_ignore_patterns(root_dir, [PACK_IGNORE])
+    ignore_files = [PACK_IGNORE]
     
     if mode == 'server':
         # Server ignores: .packignore AND .client_files
-        ignore_patterns.extend(load_ignore_patterns(root_dir, [CLIENT_FILES_IGNORE]))
+        ignore_files.append(CLIENT_FILES_IGNORE)
+        
+    ignore_patterns = load_ignore_patterns(root_dir, ignore_files)
         
     print(f"Building {mode} pack to {target_dir}...")
     
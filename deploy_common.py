@@ -0,0 +1,168 @@
+"""
+Helpers shared by deploy_smart.py and deploy_rsync.py.
+Both scripts read and write the same remote manifest and local hash cache,
+so their formats are defined here only once.
+"""
+import os
+import gzip
+import hashlib
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# orjson is optional (pip install orjson): faster and compact by default
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+    json_loads = json.loads
+
+# Gzipped JSON; the uncompressed legacy manifest is still read if no new one exists
+MANIFEST_FILENAME = 'deploy_manifest.json.gz'
+LEGACY_MANIFEST_FILENAME = 'deploy_manifest.json'
+# blake2b-256 is built into hashlib; 'blake3' requires the blake3 package.
+HASH_ALGO = os.environ.get('HASH_ALGO', 'blake2b-256')
+LEGACY_HASH_ALGO = 'md5'
+HASH_CHUNK_SIZE = 1 << 20 # 1MB reads
+# Hashes of unchanged local files (same size and mtime) are reused between runs
+LOCAL_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.deploy_local_cache.json')
+HASH_WORKERS = int(os.environ.get('DEPLOY_HASH_WORKERS', min(32, (os.cpu_count() or 1) + 4)))
+
+def _hash_constructor(algo):
+    """Returns a hashlib-style constructor for the given algorithm name."""
+    if algo == 'blake3':
+        # Optional dependency: pip install blake3
+        from blake3 import blake3
+        return blake3
+    if algo == 'blake2b-256':
+        # 32-byte digest: 64 hex chars instead of blake2b's default 128
+        return lambda: hashlib.blake2b(digest_size=32)
+    return lambda: hashlib.new(algo)
+
+def calculate_hash(filepath, algo=HASH_ALGO):
+    """
+    Calculates the hash of a file.
+    Hashes are prefixed with the algorithm name ('blake2b-256:...'),
+    except legacy MD5 hashes which are stored bare.
+    """
+    constructor = _hash_constructor(algo)
+    with open(filepath, "rb", buffering=0) as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: hashing loop runs in C
+            digest = hashlib.file_digest(f, constructor)
+        else:
+            digest = constructor()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    if algo == LEGACY_HASH_ALGO:
+        return digest.hexdigest()
+    return f"{algo}:{digest.hexdigest()}"
+
+def _scan(base, prefix=""):
+    """
+    Recursively yields (rel_path, full_path, stat_result) for every file under base.
+    Like os.walk, file types come from the directory listing and symlinked
+    directories are not followed; entry.stat() still costs one stat per file.
+    """
+    with os.scandir(base) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan(entry.path, prefix + entry.name + "/")
+            elif entry.is_file():
+                yield prefix + entry.name, entry.path, entry.stat()
+
+def scan_local_files(base_dir):
+    """Lists local files as (rel_path, full_path, stat_result) tuples."""
+    # Skip manifest itself if generated locally
+    return [entry for entry in _scan(base_dir) if entry[0] not in (MANIFEST_FILENAME, LEGACY_MANIFEST_FILENAME)]
+
+def load_hash_cache(algo):
+    """Loads the local hash cache, discarding it if it was built with another algorithm."""
+    try:
+        with open(LOCAL_CACHE_PATH, 'rb') as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    if cache.get('algo') != algo:
+        return {}
+    return cache.get('files', {})
+
+def save_hash_cache(algo, files_cache):
+    """
+    Persists hashes with the size and mtime they were computed for.
+    Raises OSError if the cache can't be written; callers report it their own way.
+    """
+    with open(LOCAL_CACHE_PATH, 'wb') as f:
+        f.write(json_dumps({'algo': algo, 'files': files_cache}))
+
+def split_cached_hashes(entries, cache):
+    """
+    Splits scanned (rel_path, full_path, stat_result) entries into
+    ({rel_path: cache_entry} for files the cache still covers, [entries to hash]).
+    """
+    # Same size and mtime means unchanged, like rsync's quick check
+    cached = {}
+    to_hash = []
+    for rel_path, full_path, stats in entries:
+        entry = cache.get(rel_path)
+        if entry and entry['size'] == stats.st_size and entry['mtime_ns'] == stats.st_mtime_ns:
+            cached[rel_path] = entry
+        else:
+            to_hash.append((rel_path, full_path, stats))
+    return cached, to_hash
+
+def hash_files(to_hash, algo):
+    """
+    Hashes (rel_path, full_path, stat_result) entries on a thread pool and
+    yields (rel_path, stat_result, hash) in completion order.
+    Closing the generator early cancels the hashes not yet started.
+    """
+    # hashlib releases the GIL while hashing, so threads scale across cores
+    executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+    try:
+        futures = {
+            executor.submit(calculate_hash, full_path, algo): (rel_path, stats)
+            for rel_path, full_path, stats in to_hash
+        }
+        for future in as_completed(futures):
+            rel_path, stats = futures[future]
+            yield rel_path, stats, future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def encode_manifest(manifest):
+    """Serializes a manifest as compact, gzipped JSON."""
+    return gzip.compress(json_dumps(manifest), compresslevel=6)
+
+def decode_manifest(data):
+    """
+    Parses a manifest, accepting both gzipped and legacy plain JSON.
+    Raises ValueError (or EOFError if truncated) for a corrupt manifest.
+    """
+    if data[:2] == b'\x1f\x8b':
+        try:
+            data = gzip.decompress(data)
+        except zlib.error as e:
+            # Not an OSError/ValueError, so callers' corrupt-manifest handling would miss it
+            raise ValueError(f"corrupt gzip data: {e}") from e
+    return json_loads(data)
+
+def manifest_hash_algo(manifest):
+    """Returns the hash algorithm used by a manifest, or None if it is empty."""
+    for info in manifest.values():
+        algo, sep, _ = info['hash'].partition(':')
+        return algo if sep else LEGACY_HASH_ALGO
+    return None
+
+def select_hash_algo(remote_state, force_full):
+    """
+    Picks the algorithm to hash local files with for this deploy.
+    Matches the remote manifest so hashes stay comparable; a full deploy
+    re-uploads everything anyway, so it migrates to HASH_ALGO.
+    """
+    if force_full:
+        return HASH_ALGO
+    return manifest_hash_algo(remote_state) or HASH_ALGO
@@ -1,9 +1,15 @@
 import os
-import hashlib
-import json
+import atexit
+import argparse
 import subprocess
 import sys
 import shlex
+import threading
+from deploy_common import (
+    MANIFEST_FILENAME, LEGACY_MANIFEST_FILENAME, HASH_ALGO,
+    scan_local_files, load_hash_cache, save_hash_cache, split_cached_hashes,
+    hash_files, encode_manifest, decode_manifest, select_hash_algo
+)
 
 # Configuration via Environment Variables
 HOST = os.environ.get('SFTP_HOST')
@@ -12,46 +18,51 @@ PASSWORD = os.environ.get('SFTP_PASS')
 PORT = os.environ.get('SFTP_PORT', '22')
 REMOTE_BASE_DIR = os.environ.get('TARGET_DIR')
 LOCAL_BASE_DIR = 'build/server'
-MANIFEST_FILENAME = 'deploy_manifest.json'
+COMPRESS = os.environ.get('DEPLOY_COMPRESS', 'true').lower() == 'true'
+# Socket of the shared SSH master connection (see start_control_master)
+CONTROL_PATH = f'/tmp/deploy-{os.getpid()}.sock'
 
-def calculate_hash(filepath):
-    """Calculates MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def get_local_files_info(base_dir):
+def get_local_files_info(base_dir, algo=HASH_ALGO, use_cache=True):
     """
     Scans local directory and returns a dict: 
-    { 'relative/path': {'hash': 'md5...', 'size': 1234} }
+    { 'relative/path': {'hash': 'blake2b-256:...', 'size': 1234} }
+    Files whose size and mtime match the local hash cache are not re-hashed.
     """
     files_info = {}
     if not os.path.exists(base_dir):
         print(f"Error: Local directory '{base_dir}' does not exist.")
         sys.exit(1)
         
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, base_dir).replace(os.path.sep, '/')
-            
-            # Skip manifest itself if generated locally
-            if rel_path == MANIFEST_FILENAME:
-                continue
-                
-            stats = os.stat(full_path)
-            file_hash = calculate_hash(full_path)
-            
-            files_info[rel_path] = {
-                'hash': file_hash,
-                'size': stats.st_size
-            }
+    entries = scan_local_files(base_dir)
+
+    cache = load_hash_cache(algo) if use_cache else {}
+    cached, to_hash = split_cached_hashes(entries, cache)
+    hashes = {rel_path: entry['hash'] for rel_path, entry in cached.items()}
+    for rel_path, _, file_hash in hash_files(to_hash, algo):
+        hashes[rel_path] = file_hash
+
+    files_cache = {}
+    for rel_path, _, stats in entries:
+        files_info[rel_path] = {
+            'hash': hashes[rel_path],
+            'size': stats.st_size
+        }
+        files_cache[rel_path] = {
+            'hash': hashes[rel_path],
+            'size': stats.st_size,
+            'mtime_ns': stats.st_mtime_ns
+        }
+    try:
+        save_hash_cache(algo, files_cache)
+    except OSError as e:
+        print(f"Warning: Could not write local hash cache: {e}")
     return files_info
 
-def run_cmd(cmd_list, env=None, check=True, capture_output=False):
-    """Runs a subprocess command with hidden password in logs."""
+def run_cmd(cmd_list, env=None, check=True, capture_output=False, input=None, text=True):
+    """
+    Runs a subprocess command with hidden password in logs.
+    `input` (str or bytes) is sent to its stdin; text=False captures output as bytes.
+    """
     display_cmd = " ".join(cmd_list).replace(PASSWORD, "*****") if PASSWORD else " ".join(cmd_list)
     print(f"Executing: {display_cmd}")
     sys.stdout.flush()
@@ -63,8 +74,9 @@ def run_cmd(cmd_list, env=None, check=True, capture_output=False):
                 cmd_list, 
                 env=env, 
                 check=check, 
-                text=True,
-                capture_output=True
+                text=text,
+                capture_output=True,
+                input=input
             )
             return result
         except subprocess.CalledProcessError as e:
@@ -78,12 +90,24 @@ def run_cmd(cmd_list, env=None, check=True, capture_output=False):
         process = subprocess.Popen(
             cmd_list,
             env=env,
+            stdin=subprocess.PIPE if input is not None else None,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT, # Merge stderr into stdout
             text=True,
             bufsize=1
         )
 
+        if input is not None:
+            # Feed stdin from a thread so a full stdout pipe can't deadlock us
+            def feed_stdin():
+                if isinstance(input, bytes):
+                    process.stdin.flush()
+                    process.stdin.buffer.write(input)
+                else:
+                    process.stdin.write(input)
+                process.stdin.close()
+            threading.Thread(target=feed_stdin, daemon=True).start()
+
         for line in process.stdout:
             print(line, end='')
             sys.stdout.flush()
@@ -96,117 +120,153 @@ def run_cmd(cmd_list, env=None, check=True, capture_output=False):
         
         return process
 
+def start_control_master(connect_opts, env):
+    """
+    Opens one SSH master connection that every later ssh/rsync call is
+    multiplexed over, so the TCP handshake and authentication happen only once.
+    With -N and ControlPersist, ssh detaches into the background after authenticating.
+    """
+    # No -vvv here: in debug mode the detached master keeps our stdout pipe open
+    master_cmd = ["sshpass", "-e", "ssh", "-M", "-S", CONTROL_PATH, "-o", "ControlPersist=5m", "-N"] + connect_opts + [f"{USER}@{HOST}"]
+    run_cmd(master_cmd, env=env, check=True)
+    atexit.register(stop_control_master)
+
+def stop_control_master():
+    """Closes the shared SSH master connection."""
+    subprocess.run(
+        ["ssh", "-S", CONTROL_PATH, "-O", "exit", f"{USER}@{HOST}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
 def main():
+    parser = argparse.ArgumentParser(description='Manifest-based server deploy via rsync')
+    parser.add_argument('--no-cache', action='store_true', help='Re-hash every local file instead of reusing cached hashes')
+    args = parser.parse_args()
+
     if not all([HOST, USER, PASSWORD, REMOTE_BASE_DIR]):
         print("Error: Missing required environment variables (SFTP_HOST, SFTP_USER, SFTP_PASS, TARGET_DIR).")
         sys.exit(1)
 
     print(f"Preparing deployment to {HOST}:{PORT}...")
     
-    # 1. State Calculation
-    print("Scanning local files...")
-    local_state = get_local_files_info(LOCAL_BASE_DIR)
-    print(f"Found {len(local_state)} local files.")
-
     # Prepare environment for commands (inject SSHPASS)
     env = os.environ.copy()
     env['SSHPASS'] = PASSWORD
     
     # Common SSH flags
+    connect_opts = ["-p", str(PORT), "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-o", "ConnectTimeout=15", "-o", "ServerAliveInterval=30"]
+    # Every later ssh/rsync call reuses the master connection through its socket
+    control_opts = ["-o", f"ControlPath={CONTROL_PATH}"]
     # -vvv: Verbose debugging for connection issues
-    ssh_opts = ["-p", str(PORT), "-vvv", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-o", "ConnectTimeout=15", "-o", "ServerAliveInterval=30"]
+    ssh_opts = ["-vvv"] + connect_opts + control_opts
     ssh_base_cmd = ["sshpass", "-e", "ssh"] + ssh_opts + [f"{USER}@{HOST}"]
 
-    # 1.5 Ensure Remote Directory Exists
+    print("Opening shared SSH connection...")
+    start_control_master(connect_opts, env)
+
+    # 1. Ensure Remote Directory Exists
     print(f"Ensuring remote directory structure: {REMOTE_BASE_DIR}")
     mkdir_cmd = ssh_base_cmd + [f"mkdir -p {shlex.quote(REMOTE_BASE_DIR)}"]
     run_cmd(mkdir_cmd, env=env, check=True)
 
     # 2. Get Remote Manifest
     manifest_path = f"{REMOTE_BASE_DIR}/{MANIFEST_FILENAME}"
+    legacy_manifest_path = f"{REMOTE_BASE_DIR}/{LEGACY_MANIFEST_FILENAME}"
     print(f"Fetching remote manifest from {manifest_path}...")
     
-    cat_cmd = ssh_base_cmd + [f"cat {shlex.quote(manifest_path)}"]
+    cat_cmd = ssh_base_cmd + [f"cat {shlex.quote(manifest_path)} 2>/dev/null || cat {shlex.quote(legacy_manifest_path)}"]
     remote_state = {}
     
-    res = run_cmd(cat_cmd, env=env, check=False, capture_output=True)
+    res = run_cmd(cat_cmd, env=env, check=False, capture_output=True, text=False)
     if res.returncode == 0:
         try:
-            remote_state = json.loads(res.stdout)
+            remote_state = decode_manifest(res.stdout)
             print(f"Loaded remote manifest. Known remote files: {len(remote_state)}")
-        except json.JSONDecodeError:
+        except (OSError, EOFError, ValueError):
             print("Remote manifest corrupted. Proceeding with full sync.")
     else:
         print("Remote manifest not found. Proceeding with full sync.")
 
-    # 3. Calculate Deletions
+    force_full = os.environ.get('FORCE_FULL', 'false').lower() == 'true'
+    if force_full:
+        print("!!! FORCED FULL DEPLOY ACTIVATED !!!")
+
+    hash_algo = select_hash_algo(remote_state, force_full)
+
+    # 3. State Calculation
+    print(f"Scanning local files and calculating {hash_algo} hashes...")
+    local_state = get_local_files_info(LOCAL_BASE_DIR, hash_algo, use_cache=not (args.no_cache or force_full))
+    print(f"Found {len(local_state)} local files.")
+
+    # 4. Compare & Plan Uploads and Deletions
+    files_to_upload = []
+    for rel_path, info in local_state.items():
+        if (rel_path not in remote_state
+                or force_full
+                or remote_state[rel_path]['hash'] != info['hash']):
+            files_to_upload.append(rel_path)
+
     # Only delete files that are in the remote manifest (managed by us) but not in local state.
     files_to_delete = []
     for rel_path in remote_state:
         if rel_path not in local_state:
             files_to_delete.append(rel_path)
     
-    print(f"Found {len(files_to_delete)} files to delete.")
-
-    # 4. Execute Deletions
-    if files_to_delete:
-        print("--- Deleting removed files ---")
-        # Construct `rm` commands in batches to avoid command length limits
-        batch_size = 50
-        for i in range(0, len(files_to_delete), batch_size):
-            batch = files_to_delete[i:i+batch_size]
-            paths_to_remove = [f"{REMOTE_BASE_DIR}/{p}" for p in batch]
-            quoted_paths = [shlex.quote(p) for p in paths_to_remove]
-            
-            rm_cmd = ssh_base_cmd + ["rm -f"] + quoted_paths
-            run_cmd(rm_cmd, env=env, check=True)
-            print(f"Deleted batch {i // batch_size + 1}")
-
-    # 5. Execute Sync via Rsync (Uploads/Updates)
-    print("--- Syncing files via Rsync ---")
-    local_dir = LOCAL_BASE_DIR.rstrip('/') + '/'
-    
-    rsync_ssh_cmd = f"ssh -p {PORT} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
-    
-    # -a: archive
-    # -v: verbose
-    # -z: compress
-    # -c: use checksums (slower but safer)
-    # --no-perms: don't error on permission setting failures (common on some FS)
-    # --timeout=60: I/O timeout
-    rsync_cmd = [
-        "sshpass", "-e",
-        "rsync",
-        "-avzc",
-        "--no-perms",
-        "--timeout=60",
-        "--progress",
-        "-e", rsync_ssh_cmd,
-        local_dir,
-        f"{USER}@{HOST}:{REMOTE_BASE_DIR}/"
-    ]
-    
-    # We do NOT use --delete here because we already handled deletions safely based on the manifest.
-    run_cmd(rsync_cmd, env=env, check=True)
+    print(f"Summary: {len(files_to_upload)} files to upload, {len(files_to_delete)} files to delete.")
+
+    # 5. Execute Sync via Rsync (Uploads/Updates and Deletions)
+    if files_to_upload or files_to_delete:
+        print("--- Syncing files via Rsync ---")
+        local_dir = LOCAL_BASE_DIR.rstrip('/') + '/'
+        
+        rsync_ssh_cmd = " ".join(["ssh", "-p", str(PORT), "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"] + control_opts)
+        
+        # -rlt: recursive, symlinks, times
+        # -v: verbose
+        # -z: compress (DEPLOY_COMPRESS; rsync already skips jar/zip/png by default)
+        # --ignore-times: the manifest diff already decided what changed, so don't
+        #   re-check size/mtime (and no -c: no checksumming every file on both sides)
+        # --no-perms: don't error on permission setting failures (common on some FS)
+        # --timeout=60: I/O timeout
+        # --files-from=- --from0: only the paths listed on stdin (NUL-separated)
+        # --delete-missing-args: listed paths missing locally are deleted remotely,
+        #   which handles the manifest-based deletions in the same session
+        rsync_cmd = [
+            "sshpass", "-e",
+            "rsync",
+            "-rltvz" if COMPRESS else "-rltv",
+            "--ignore-times",
+            "--no-perms",
+            "--timeout=60",
+            "--progress",
+            "--files-from=-",
+            "--from0",
+            "--delete-missing-args",
+            "-e", rsync_ssh_cmd,
+            local_dir,
+            f"{USER}@{HOST}:{REMOTE_BASE_DIR}/"
+        ]
+        
+        file_list = "".join(f"{p}\0" for p in files_to_upload + files_to_delete)
+        run_cmd(rsync_cmd, env=env, check=True, input=file_list)
+    else:
+        print("Nothing to sync.")
 
     # 6. Upload New Manifest
     print("Updating remote manifest...")
-    manifest_local_path = "new_manifest.json"
-    with open(manifest_local_path, 'w') as f:
-        json.dump(local_state, f)
+    manifest_data = encode_manifest(local_state)
     
-    # Use rsync to upload manifest too, for consistency
-    manifest_upload_cmd = [
-        "sshpass", "-e",
-        "rsync",
-        "-avz",
-        "-e", rsync_ssh_cmd,
-        manifest_local_path,
-        f"{USER}@{HOST}:{manifest_path}"
+    # Stream the manifest from memory over ssh; write to a temp file and rename
+    # so an interrupted upload never leaves a truncated manifest behind.
+    # The legacy uncompressed manifest is superseded and removed.
+    manifest_tmp_path = f"{manifest_path}.tmp"
+    manifest_upload_cmd = ssh_base_cmd + [
+        f"cat > {shlex.quote(manifest_tmp_path)} && mv {shlex.quote(manifest_tmp_path)} {shlex.quote(manifest_path)}"
+        f" && rm -f {shlex.quote(legacy_manifest_path)}"
     ]
     
-    run_cmd(manifest_upload_cmd, env=env, check=True)
-    os.remove(manifest_local_path)
+    run_cmd(manifest_upload_cmd, env=env, check=True, input=manifest_data)
     
     print("Deployment complete.")
 
@@ -1,11 +1,21 @@
 import os
-import hashlib
-import json
+import argparse
+import io
 import paramiko
 import sys
 import logging
+import queue
+import shlex
+import socket
+import threading
 import time
 from stat import S_ISDIR
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from deploy_common import (
+    MANIFEST_FILENAME, LEGACY_MANIFEST_FILENAME, HASH_ALGO,
+    scan_local_files, load_hash_cache, save_hash_cache, split_cached_hashes,
+    hash_files, encode_manifest, decode_manifest, select_hash_algo
+)
 
 # Setup logging
 logging.basicConfig(
@@ -23,39 +33,51 @@ PASSWORD = os.environ.get('SFTP_PASS')
 PORT = int(os.environ.get('SFTP_PORT', 22))
 REMOTE_BASE_DIR = os.environ.get('TARGET_DIR')
 LOCAL_BASE_DIR = 'build/server'
-MANIFEST_FILENAME = 'deploy_manifest.json'
-
-def calculate_hash(filepath):
-    """Calculates MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def get_local_files_info(base_dir):
-    """
-    Scans local directory and returns a dict: 
-    { 'relative/path': {'hash': 'md5...', 'size': 1234} }
-    """
-    files_info = {}
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, base_dir).replace(os.path.sep, '/')
-            
-            # Skip manifest itself if generated locally
-            if rel_path == MANIFEST_FILENAME:
-                continue
-                
-            stats = os.stat(full_path)
-            file_hash = calculate_hash(full_path)
-            
-            files_info[rel_path] = {
-                'hash': file_hash,
-                'size': stats.st_size
-            }
-    return files_info
+DELETE_BATCH_SIZE = 100
+REMOTE_EXEC_TIMEOUT = 60
+# Printed after a successful rm; a forced command (e.g. internal-sftp) won't print it
+DELETE_DONE_MARKER = 'deploy-rm-ok'
+UPLOAD_WORKERS = int(os.environ.get('DEPLOY_UPLOAD_WORKERS', 4))
+PREFERRED_CIPHERS = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com')
+WINDOW_SIZE = int(os.environ.get('SFTP_WINDOW_SIZE', 8192))
+MAX_PACKET_SIZE = int(os.environ.get('SFTP_MAX_PACKET_SIZE', 1024))
+
+def prefer_ciphers(available):
+    """
+    Moves PREFERRED_CIPHERS supported by this paramiko version to the front.
+    paramiko encrypts through cryptography/OpenSSL (AES-NI) either way, but
+    AES-GCM authenticates in the same call, saving the separate HMAC pass
+    per packet that AES-CTR needs - noticeable with our tiny packets.
+    """
+    preferred = [c for c in PREFERRED_CIPHERS if c in available]
+    return tuple(preferred + [c for c in available if c not in preferred])
+
+def iter_local_files_info(entries, algo=HASH_ALGO, use_cache=True):
+    """
+    Yields (rel_path, {'hash': 'blake2b-256:...', 'size': 1234}) for scanned files
+    as soon as each hash is known: cached hashes first, then the rest in
+    completion order. Files whose size and mtime match the local hash cache
+    are not re-hashed. The cache is saved once every file has been yielded.
+    """
+    cache = load_hash_cache(algo) if use_cache else {}
+    cached, to_hash = split_cached_hashes(entries, cache)
+
+    files_cache = dict(cached)
+    for rel_path, entry in cached.items():
+        yield rel_path, {'hash': entry['hash'], 'size': entry['size']}
+
+    for rel_path, stats, file_hash in hash_files(to_hash, algo):
+        files_cache[rel_path] = {
+            'hash': file_hash,
+            'size': stats.st_size,
+            'mtime_ns': stats.st_mtime_ns
+        }
+        yield rel_path, {'hash': file_hash, 'size': stats.st_size}
+
+    try:
+        save_hash_cache(algo, files_cache)
+    except OSError as e:
+        logger.warning(f"Could not write local hash cache: {e}")
 
 def sftp_walk(sftp, remote_path):
     """Non-recursive helper to verify directory existence (not used for diffing anymore)."""
@@ -65,18 +87,170 @@ def sftp_walk(sftp, remote_path):
     except IOError:
         return False
 
+# Remote directories known to exist during this run
+_known_remote_dirs = set()
+
 def ensure_remote_dir(sftp, remote_path):
-    """Recursively creates remote directories."""
+    """
+    Recursively creates remote directories.
+    Issues mkdir directly instead of stat-then-mkdir; an IOError means the directory already exists.
+    Directories created or verified earlier in this run are skipped. Safe to call concurrently:
+    mkdir is idempotent here and set updates are atomic.
+    """
+    if remote_path in _known_remote_dirs:
+        return
     dirs = remote_path.split('/')
     current_path = ""
     for dir_part in dirs:
         if not dir_part: continue
         current_path += "/" + dir_part
+        if current_path in _known_remote_dirs:
+            continue
         try:
-            sftp.stat(current_path)
-        except IOError:
-            logger.info(f"Creating remote directory: {current_path}")
             sftp.mkdir(current_path)
+            logger.info(f"Created remote directory: {current_path}")
+        except IOError:
+            pass
+        _known_remote_dirs.add(current_path)
+
+def create_remote_dirs(sftp, rel_paths):
+    """
+    Creates the parent directories of all rel_paths below REMOTE_BASE_DIR,
+    one mkdir per unique directory, parents first (like mkdir -p / rsync --mkpath).
+    """
+    rel_dirs = {rel_path.rpartition('/')[0] for rel_path in rel_paths}
+    for rel_dir in sorted(rel_dirs):
+        ensure_remote_dir(sftp, f"{REMOTE_BASE_DIR}/{rel_dir}" if rel_dir else REMOTE_BASE_DIR)
+    # Make sure the base directory exists even with nothing to upload
+    ensure_remote_dir(sftp, REMOTE_BASE_DIR)
+
+def remote_exec(transport, command, timeout=REMOTE_EXEC_TIMEOUT):
+    """
+    Runs a shell command on the server and returns (exit_status, output),
+    with stderr merged into output. Raises socket.timeout if the command
+    doesn't finish within `timeout` seconds.
+    """
+    channel = transport.open_session(timeout=timeout)
+    try:
+        channel.settimeout(timeout)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        # Send EOF right away: if the server replaces the command with one that
+        # reads stdin (ForceCommand internal-sftp), it exits instead of waiting forever
+        channel.shutdown_write()
+        output = channel.makefile('rb').read()
+        if not channel.status_event.wait(timeout):
+            raise socket.timeout(f"no exit status after {timeout}s")
+        return channel.recv_exit_status(), output
+    finally:
+        channel.close()
+
+def delete_remote_files(transport, sftp, rel_paths):
+    """
+    Deletes remote files with one 'rm -f' per batch instead of one SFTP round trip per file.
+    If a batch can't be confirmed deleted (exec refused, timed out, failed, or replaced
+    by a forced command on SFTP-only hosts), that batch and all later ones are removed via SFTP.
+    """
+    total = len(rel_paths)
+    use_exec = True
+    for start in range(0, total, DELETE_BATCH_SIZE):
+        batch = rel_paths[start:start + DELETE_BATCH_SIZE]
+        if use_exec:
+            quoted_paths = [shlex.quote(f"{REMOTE_BASE_DIR}/{p}") for p in batch]
+            command = f"rm -f -- {' '.join(quoted_paths)} && echo {DELETE_DONE_MARKER}"
+            try:
+                status, output = remote_exec(transport, command)
+            except (paramiko.SSHException, socket.timeout) as e:
+                reason = str(e) or type(e).__name__
+            else:
+                if status == 0 and output.rstrip().endswith(DELETE_DONE_MARKER.encode()):
+                    logger.info(f"Deleted {start + len(batch)}/{total} files")
+                    continue
+                reason = f"exit status {status}, output {output.decode(errors='replace').strip()[-200:]!r}"
+            logger.warning(f"Shell commands not usable ({reason}). Deleting via SFTP.")
+            use_exec = False
+
+        for i, rel_path in enumerate(batch, start + 1):
+            remote_path = f"{REMOTE_BASE_DIR}/{rel_path}"
+            logger.info(f"[{i}/{total}] Deleting: {rel_path}")
+            try:
+                sftp.remove(remote_path)
+            except IOError as e:
+                logger.error(f"Failed to delete {remote_path}: {e}")
+
+def upload_file(sftp, rel_path, size, index):
+    """Uploads a single file of the local build to the remote base directory."""
+    local_path = os.path.join(LOCAL_BASE_DIR, rel_path)
+    remote_path = f"{REMOTE_BASE_DIR}/{rel_path}"
+    logger.info(f"[{index}] Uploading: {rel_path} (Size: {size} bytes)")
+    
+    try:
+        callback = ProgressCallback(rel_path)
+        # sftp.put(local_path, remote_path, callback=callback)
+        try:
+            manual_sftp_put(sftp, local_path, remote_path, callback=callback)
+        except FileNotFoundError:
+            # Only new files get their parent created up front; a changed file's
+            # directory may have been removed on the server since the last deploy
+            logger.warning(f"Remote directory missing for {rel_path}, creating it and retrying")
+            ensure_remote_dir(sftp, remote_path.rpartition('/')[0])
+            manual_sftp_put(sftp, local_path, remote_path, callback=callback)
+        logger.info(f"Finished uploading {rel_path}")
+    except Exception as e:
+        logger.error(f"Failed to upload {rel_path}: {e}")
+        # Don't break immediately, or do? If network is dead, next one will tail too.
+        # Usually best to raise to fail the CI
+        raise e
+
+def upload_files(transport, files):
+    """
+    Uploads (rel_path, size) pairs in parallel and returns the number uploaded.
+    `files` may be a generator that keeps producing work while earlier uploads run.
+    Every worker gets its own SFTP channel: channels are independent streams
+    multiplexed over the one SSH transport, so the small per-channel window
+    no longer serializes all transfers. Remote parent directories must already exist.
+    The first failed upload stops pulling from `files`, cancels queued uploads
+    and is re-raised once the running ones have finished.
+    """
+    channels = queue.Queue()
+    failed = threading.Event()
+    errors = []
+
+    def upload_one(index, rel_path, size):
+        if failed.is_set():
+            # An earlier upload failed and the deploy is being aborted
+            return
+        try:
+            try:
+                sftp = channels.get_nowait()
+            except queue.Empty:
+                sftp = paramiko.SFTPClient.from_transport(transport)
+            try:
+                upload_file(sftp, rel_path, size, index)
+            finally:
+                channels.put(sftp)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+            raise
+
+    executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    futures = []
+    try:
+        for index, (rel_path, size) in enumerate(files, 1):
+            # Stop hashing and queueing more work as soon as an upload fails
+            if failed.is_set():
+                break
+            futures.append(executor.submit(upload_one, index, rel_path, size))
+        wait(futures, return_when=FIRST_EXCEPTION)
+        if errors:
+            # Re-raises the earliest failed upload
+            raise errors[0]
+    finally:
+        executor.shutdown(cancel_futures=True)
+        while not channels.empty():
+            channels.get().close()
+    return len(futures)
 
 def manual_sftp_put(sftp, local_path, remote_path, callback=None):
     """
@@ -100,25 +274,43 @@ def manual_sftp_put(sftp, local_path, remote_path, callback=None):
                 if callback:
                     callback(transferred, total_size)
 
-def create_progress_callback(filename):
-    start_time = time.time()
-    last_log_time = start_time
-    
-    def progress_callback(transferred, total):
-        nonlocal last_log_time
-        current_time = time.time()
-        
-        # Log every 5 seconds or on completion
-        if current_time - last_log_time > 5 or transferred == total:
-            percentage = (transferred / total) * 100 if total > 0 else 0
-            elapsed = current_time - start_time
-            speed = (transferred / 1024 / 1024) / elapsed if elapsed > 0 else 0
-            logger.info(f"Transferring {filename}: {percentage:.1f}% ({transferred}/{total} bytes) - {speed:.2f} MB/s")
-            last_log_time = current_time
-            
-    return progress_callback
+class ProgressCallback:
+    """
+    Logs transfer progress every 5 seconds or 1MB, and on completion.
+    Called once per written chunk; time.monotonic() is a vDSO call on Linux,
+    so checking both conditions on every chunk stays cheap.
+    """
+    __slots__ = ('filename', 'start_time', 'last_log_time', 'last_log_bytes')
+
+    LOG_INTERVAL = 5
+    LOG_BYTES = 1 << 20
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.start_time = self.last_log_time = time.monotonic()
+        self.last_log_bytes = 0
+
+    def __call__(self, transferred, total):
+        current_time = time.monotonic()
+        if (transferred != total
+                and transferred - self.last_log_bytes < self.LOG_BYTES
+                and current_time - self.last_log_time <= self.LOG_INTERVAL):
+            return
+
+        percentage = (transferred / total) * 100 if total > 0 else 0
+        elapsed = current_time - self.start_time
+        speed = (transferred / 1024 / 1024) / elapsed if elapsed > 0 else 0
+        # Lazy %-formatting: skipped entirely if INFO is disabled
+        logger.info("Transferring %s: %.1f%% (%d/%d bytes) - %.2f MB/s",
+                    self.filename, percentage, transferred, total, speed)
+        self.last_log_time = current_time
+        self.last_log_bytes = transferred
 
 def main():
+    parser = argparse.ArgumentParser(description='Manifest-based server deploy via SFTP')
+    parser.add_argument('--no-cache', action='store_true', help='Re-hash every local file instead of reusing cached hashes')
+    args = parser.parse_args()
+
     logger.info(f"Connecting to {HOST}:{PORT} as {USER}...")
     
     try:
@@ -128,119 +320,116 @@ def main():
         # Tweak transport settings to avoid MTU/Window hangs on VPNs (like WireGuard)
         # Using conservative values to prevent packet fragmentation/dropping
         # MTU is likely ~1420 or lower. We use 1024 bytes per packet to be safe.
-        transport.default_window_size = 8192 # 8KB Window
-        transport.default_max_packet_size = 1024 # 1KB Packet limit (Fits 1420 MTU)
+        # Links without MTU problems can raise both via SFTP_WINDOW_SIZE / SFTP_MAX_PACKET_SIZE.
+        transport.default_window_size = WINDOW_SIZE # 8KB Window
+        transport.default_max_packet_size = MAX_PACKET_SIZE # 1KB Packet limit (Fits 1420 MTU)
+        
+        security_options = transport.get_security_options()
+        security_options.ciphers = prefer_ciphers(security_options.ciphers)
         
         transport.connect(username=USER, password=PASSWORD)
+        logger.info(f"Negotiated cipher: {transport.local_cipher}")
         sftp = paramiko.SFTPClient.from_transport(transport)
     except Exception as e:
         logger.error(f"Failed to connect: {e}")
         sys.exit(1)
 
-    # 1. Calculate Local state
-    logger.info("Scanning local files and calculating hashes...")
-    local_state = get_local_files_info(LOCAL_BASE_DIR)
-    logger.info(f"Found {len(local_state)} local files.")
-
-    # 2. Get Remote Manifest
+    # 1. Get Remote Manifest
     remote_state = {}
     manifest_path = f"{REMOTE_BASE_DIR}/{MANIFEST_FILENAME}"
+    legacy_manifest_path = f"{REMOTE_BASE_DIR}/{LEGACY_MANIFEST_FILENAME}"
+    loaded_legacy_manifest = False
     logger.info(f"Checking for remote manifest at {manifest_path}...")
     try:
-        with sftp.open(manifest_path, 'r') as f:
-            remote_state = json.load(f)
+        try:
+            with sftp.open(manifest_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            with sftp.open(legacy_manifest_path, 'rb') as f:
+                data = f.read()
+            loaded_legacy_manifest = True
+        remote_state = decode_manifest(data)
         logger.info(f"Loaded remote manifest. Known remote files: {len(remote_state)}")
-    except (IOError, json.JSONDecodeError):
+    except (IOError, EOFError, ValueError):
         logger.warning("Remote manifest not found or invalid. Performing full sync.")
 
-    # 3. Compare & Plan Uploads
-    files_to_upload = []
     force_full = os.environ.get('FORCE_FULL', 'false').lower() == 'true'
     
     if force_full:
         logger.info("!!! FORCED FULL DEPLOY ACTIVATED !!!")
 
-    for rel_path, info in local_state.items():
-        need_upload = False
-        reason = ""
-        
-        if rel_path not in remote_state:
-            need_upload = True 
-            reason = "New file"
-        elif force_full:
-            need_upload = True
-            reason = "Forced full"
-        elif remote_state[rel_path]['hash'] != info['hash']:
-            need_upload = True
-            reason = "Hash mismatch"
-        
-        if need_upload:
-            files_to_upload.append(rel_path)
-    
-    # 4. Compare & Plan Deletions (Safe Delete)
+    hash_algo = select_hash_algo(remote_state, force_full)
+
+    # 2. Scan Local files
+    logger.info("Scanning local files...")
+    entries = scan_local_files(LOCAL_BASE_DIR)
+    logger.info(f"Found {len(entries)} local files.")
+
+    # 3. Compare & Plan Deletions (Safe Delete)
     # Only delete files that are in the remote manifest (we put them there) 
     # BUT are no longer in the local build.
+    local_paths = {rel_path for rel_path, _, _ in entries}
     files_to_delete = []
     for rel_path in remote_state:
-        if rel_path not in local_state:
+        if rel_path not in local_paths:
             files_to_delete.append(rel_path)
 
-    logger.info(f"Summary: {len(files_to_upload)} files to upload, {len(files_to_delete)} files to delete.")
+    # A managed file replaced by a directory (config/foo -> config/foo/bar) must be
+    # deleted before that directory can be created, so those go first
+    local_dirs = set()
+    for rel_path in local_paths:
+        rel_dir = rel_path.rpartition('/')[0]
+        while rel_dir and rel_dir not in local_dirs:
+            local_dirs.add(rel_dir)
+            rel_dir = rel_dir.rpartition('/')[0]
+    blocking_files = [p for p in files_to_delete if p in local_dirs]
+    if blocking_files:
+        logger.info(f"--- Deleting {len(blocking_files)} files replaced by directories ---")
+        delete_remote_files(transport, sftp, blocking_files)
+        files_to_delete = [p for p in files_to_delete if p not in local_dirs]
+
+    # 4. Hash & Upload (pipelined)
+    # Uploads start as soon as a file is known to be new or changed, so hashing
+    # and network transfer overlap. Parent directories of new files are created
+    # up front; changed files normally have theirs already, and upload_file
+    # recreates it if it has gone missing.
+    create_remote_dirs(sftp, [p for p in local_paths if force_full or p not in remote_state])
+
+    local_state = {}
+
+    def changed_files():
+        # Runs on the main thread, fed by the hashing pool
+        for rel_path, info in iter_local_files_info(entries, hash_algo, use_cache=not (args.no_cache or force_full)):
+            local_state[rel_path] = info
+            if (rel_path not in remote_state
+                    or force_full
+                    or remote_state[rel_path]['hash'] != info['hash']):
+                yield rel_path, info['size']
+
+    logger.info(f"--- Calculating {hash_algo} hashes and uploading changed files ---")
+    uploaded = upload_files(transport, changed_files())
+    logger.info(f"Uploaded {uploaded} files." if uploaded else "No files to upload.")
 
     # 5. Execute Delete
+    logger.info(f"{len(files_to_delete)} files to delete.")
     if files_to_delete:
         logger.info("--- Deleting removed files ---")
-        for i, rel_path in enumerate(files_to_delete):
-            remote_path = f"{REMOTE_BASE_DIR}/{rel_path}"
-            logger.info(f"[{i+1}/{len(files_to_delete)}] Deleting: {rel_path}")
-            try:
-                sftp.remove(remote_path)
-            except IOError as e:
-                logger.error(f"Failed to delete {remote_path}: {e}")
+        delete_remote_files(transport, sftp, files_to_delete)
 
-    # 6. Execute Upload
-    if files_to_upload:
-        logger.info("--- Uploading files ---")
-        for i, rel_path in enumerate(files_to_upload):
-            local_path = os.path.join(LOCAL_BASE_DIR, rel_path)
-            remote_path = f"{REMOTE_BASE_DIR}/{rel_path}"
-            remote_dir = os.path.dirname(remote_path)
-            
-            try:
-                sftp.stat(remote_path)
-                # sftp.posix_rename(remote_path, remote_path) # check exists cheap
-            except IOError:
-                 ensure_remote_dir(sftp, remote_dir)
-
-            logger.info(f"[{i+1}/{len(files_to_upload)}] Uploading: {rel_path} (Size: {local_state[rel_path]['size']} bytes)")
-            
-            try:
-                callback = create_progress_callback(rel_path)
-                # sftp.put(local_path, remote_path, callback=callback)
-                manual_sftp_put(sftp, local_path, remote_path, callback=callback)
-                logger.info(f"Finished uploading {rel_path}")
-            except Exception as e:
-                logger.error(f"Failed to upload {rel_path}: {e}")
-                # Don't break immediately, or do? If network is dead, next one will tail too.
-                # Usually best to raise to fail the CI
-                raise e
-    else:
-        logger.info("No files to upload.")
-
-    # 7. Upload New Manifest
+    # 6. Upload New Manifest
     logger.info("Updating remote manifest...")
-    # Using local_state as the new manifest effectively
-    with open('new_manifest.json', 'w') as f:
-        json.dump(local_state, f)
+    # Using local_state as the new manifest effectively, uploaded straight from memory
+    payload = encode_manifest(local_state)
     
     try:
-        sftp.put('new_manifest.json', manifest_path)
+        sftp.putfo(io.BytesIO(payload), manifest_path, file_size=len(payload))
         logger.info("Manifest updated successfully.")
+        if loaded_legacy_manifest:
+            # Superseded by the gzipped manifest
+            sftp.remove(legacy_manifest_path)
     except Exception as e:
          logger.error(f"Failed to upload manifest: {e}")
 
-    os.remove('new_manifest.json')
-
     sftp.close()
     transport.close()
     logger.info("Deployment complete.")